@@ -1,42 +1,73 @@
 ## This file has all the augmentation done for Task1
+import asyncio
+import os
+from concurrent.futures import ProcessPoolExecutor
 import nlpaug.augmenter.word as naw
-from tqdm import tqdm
 import pandas as pd
 import numpy as np
 import nltk
-import random
 
-nltk.download('averaged_perceptron_tagger')
-nltk.download('wordnet')
-from random import shuffle
+for resource, name in [('taggers/averaged_perceptron_tagger', 'averaged_perceptron_tagger'),
+                       ('corpora/wordnet', 'wordnet')]:
+    try:
+        nltk.data.find(resource)
+    except LookupError:
+        nltk.download(name)
 
 
-def augment_text(df, samples=150000, pr=0.2):
-    new_text = []
-    esci_labels = []
+_syn_aug = None
 
-    ## selecting the minority class samples
-    df_n=df[df.target==1].reset_index(drop=True)
 
-    product_titles = []
+def _init_worker():
+    ## each worker process builds its own augmenter, the wordnet/tagger state is not shared across processes
+    global _syn_aug
+    _syn_aug = naw.SynonymAug(aug_src='wordnet')
 
-    ## data augmentation loop
-    for i in tqdm(np.random.randint(0, len(df), samples)):
-        text = df.iloc[i]['query']
-        esci_label = df.iloc[i]['esci_label']
-        product_title = df.iloc[i]['product_title']
-        syn_aug = naw.SynonymAug(aug_src='wordnet')
-        augmented_text = syn_aug.augment(text)
-        new_text.append(augmented_text)
-        product_titles.append(product_title)
-        esci_labels.append(esci_label)
+
+def _augment_batch(queries):
+    return _syn_aug.augment(queries)
+
+
+async def _augment_batches(batches, n_jobs):
+    loop = asyncio.get_running_loop()
+    ## bounds the batches in flight, so pending work waits here instead of piling up in the pool's queue
+    semaphore = asyncio.Semaphore(n_jobs)
+    with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker) as pool:
+        async def run(batch):
+            async with semaphore:
+                return await loop.run_in_executor(pool, _augment_batch, batch)
+
+        return await asyncio.gather(*(run(batch) for batch in batches))
+
+
+def augment_text(df, samples=150000, pr=0.2, n_jobs=None, batch_size=64, random_state=None):
+    ## augmented rows are reused across runs with the same seed and input size; unseeded runs are never cached
+    cache_path = f".aug_cache_{samples}_{random_state}_{len(df)}.parquet" if random_state is not None else None
+    if cache_path is not None and os.path.exists(cache_path):
+        return pd.read_parquet(cache_path)
+
+    n_jobs = n_jobs or os.cpu_count() or 1
+
+    ## selecting the minority class samples, sampled without replacement so no row is augmented twice
+    minority = np.flatnonzero(df['esci_label'].isin(['complement', 'irrelevant']).to_numpy())
+    rng = np.random.default_rng(random_state)
+    idx = rng.choice(minority, size=min(samples, len(minority)), replace=False)
+    queries = df['query'].to_numpy()[idx]
+    product_titles = df['product_title'].to_numpy()[idx].tolist()
+    esci_labels = df['esci_label'].to_numpy()[idx].tolist()
+
+    ## data augmentation, only the queries are shipped to the workers, in batches of batch_size
+    batches = [queries[i:i + batch_size].tolist() for i in range(0, len(idx), batch_size)]
+    results = asyncio.run(_augment_batches(batches, n_jobs))
+    new_text = [text for texts in results for text in texts]
 
     esci_label2gain = {'exact': 1.0, 'substitute': 0.1, 'complement': 0.01, 'irrelevant': 0.0}
 
     ## dataframe
     new = pd.DataFrame({'query': new_text, 'product_title': product_titles, 'esci_label': esci_labels})
-    new['gain'] = new['esci_label'].apply(lambda label: esci_label2gain[label])
-    df = shuffle(df.append(new).reset_index(drop=True))
+    new['gain'] = new['esci_label'].map(esci_label2gain).astype(np.float32)
+    if cache_path is not None:
+        new.to_parquet(cache_path, compression='zstd')
 
     return new
 
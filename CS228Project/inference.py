@@ -20,25 +20,38 @@ from transformers import AutoTokenizer, AutoModelForSequenceClassification, Auto
 from tqdm import tqdm
 import re
 
+_UNIT_MAP = {
+    'gal': 'gallon', 'gals': 'gallon', 'galon': 'gallon',
+    'ft': 'feet', 'fts': 'feet', 'feets': 'feet', 'foot': 'feet', 'foots': 'feet',
+    'squares': 'square', 'sq': 'square',
+    'lb': 'pound', 'lbs': 'pound', 'pounds': 'pound',
+    'oz': 'ounce', 'ozs': 'ounce', 'ounces': 'ounce', 'ounc': 'ounce',
+    'yds': 'yard', 'yd': 'yard', 'yards': 'yard',
+}
+## lookarounds instead of consuming the spaces, so adjacent units are all rewritten in one pass
+_RX_UNITS = re.compile(r'(?<= )(' + '|'.join(map(re.escape, _UNIT_MAP)) + r')(?= )')
+_RX_WORDS = re.compile(r'\W+')
+_RX_LETTERS = re.compile(r'[A-Za-z]+')
+
 def standardize_units(text):
   text = " " + text + " "
-  text = re.sub('( gal | gals | galon )',' gallon ',text)
-  text = re.sub('( ft | fts | feets | foot | foots )',' feet ',text)
-  text = re.sub('( squares | sq )',' square ',text)
-  text = re.sub('( lb | lbs | pounds )',' pound ',text)
-  text = re.sub('( oz | ozs | ounces | ounc )',' ounce ',text)
-  text = re.sub('( yds | yd | yards )',' yard ',text)
+  text = _RX_UNITS.sub(lambda ele: _UNIT_MAP[ele[1]],text)
   return text
 
 def preprocess(text):
     text=text.replace('in.',' inch ')
-    words=re.split(r'\W+',text)
+    words=_RX_WORDS.split(text)
     words=[word.lower() for word in words]
-    res=re.sub("[A-Za-z]+",lambda ele: " " + ele[0] + " ",' '.join(words))
+    res=_RX_LETTERS.sub(lambda ele: " " + ele[0] + " ",' '.join(words))
     res=standardize_units(res)
     cleaned=' '.join(res.split())
     return cleaned
 
+def preprocess_column(column):
+    ## queries and titles repeat across many rows, so each distinct string is preprocessed only once
+    unique = column.unique()
+    return column.map(dict(zip(unique, map(preprocess, unique))))
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("test_path_file", type=str, help="Input test CSV with the pairs of queries and products.")
@@ -76,8 +89,8 @@ def main():
     n_examples = len(features_query)
     scores = np.zeros(n_examples)
     if args.locale == "us":
-        df['product_title'] = df.apply(lambda x: preprocess(x.product_title), axis=1)
-        df['query'] = df.apply(lambda x: preprocess(x.query), axis=1)
+        df['product_title'] = preprocess_column(df['product_title'])
+        df['query'] = preprocess_column(df['query'])
         """ 2. Prepare Cross-encoder model """
         model = AutoModelForSequenceClassification.from_pretrained(args.model_path).to(device)
         tokenizer = AutoTokenizer.from_pretrained(args.model_path)
@@ -13,11 +13,14 @@
 #   limitations under the License.
 
 import argparse
+import os
 from sentence_transformers.cross_encoder import CrossEncoder
 from sentence_transformers.cross_encoder.evaluation import CERerankingEvaluator
 from sentence_transformers.cross_encoder.evaluation import CECorrelationEvaluator
 from sentence_transformers import SentenceTransformer, InputExample, losses
 from sentence_transformers import evaluation
+from numba import njit
+import numpy as np
 import pandas as pd
 import torch
 from torch.utils.data import DataLoader
@@ -25,30 +28,133 @@ from sklearn.model_selection import train_test_split
 from augmentation import augment_text
 import re
 
+_UNIT_MAP = {
+    'gal': 'gallon', 'gals': 'gallon', 'galon': 'gallon',
+    'ft': 'feet', 'fts': 'feet', 'feets': 'feet', 'foot': 'feet', 'foots': 'feet',
+    'squares': 'square', 'sq': 'square',
+    'lb': 'pound', 'lbs': 'pound', 'pounds': 'pound',
+    'oz': 'ounce', 'ozs': 'ounce', 'ounces': 'ounce', 'ounc': 'ounce',
+    'yds': 'yard', 'yd': 'yard', 'yards': 'yard',
+}
+## lookarounds instead of consuming the spaces, so adjacent units are all rewritten in one pass
+_RX_UNITS = re.compile(r'(?<= )(' + '|'.join(map(re.escape, _UNIT_MAP)) + r')(?= )')
+_RX_WORDS = re.compile(r'\W+')
+_RX_LETTERS = re.compile(r'[A-Za-z]+')
+_RX_HTML = re.compile(r'<[^>]+>', re.S)
+
 def clean_text(text):
-    pattern=re.compile(r'<[^>]+>',re.S)
-    text=pattern.sub('',text)
+    text=_RX_HTML.sub('',text)
     return text
 
 def standardize_units(text):
   text = " " + text + " "
-  text = re.sub('( gal | gals | galon )',' gallon ',text)
-  text = re.sub('( ft | fts | feets | foot | foots )',' feet ',text)
-  text = re.sub('( squares | sq )',' square ',text)
-  text = re.sub('( lb | lbs | pounds )',' pound ',text)
-  text = re.sub('( oz | ozs | ounces | ounc )',' ounce ',text)
-  text = re.sub('( yds | yd | yards )',' yard ',text)
+  text = _RX_UNITS.sub(lambda ele: _UNIT_MAP[ele[1]],text)
   return text
 
+@njit(cache=True)
+def _normalize_bytes(buf):
+    ## ascii fast path of preprocess: lowercases, turns non-word bytes into spaces and
+    ## splits letter runs from the digits/underscores around them, in a single pass
+    out = np.empty(2 * len(buf), dtype=np.uint8)
+    n = 0
+    prev = 0
+    for i in range(len(buf)):
+        c = buf[i]
+        if 65 <= c <= 90:
+            c = c + 32
+        if 97 <= c <= 122:
+            kind = 1
+        elif 48 <= c <= 57 or c == 95:
+            kind = 2
+        else:
+            kind = 0
+            c = 32
+        if kind != 0 and prev != 0 and kind != prev:
+            out[n] = 32
+            n += 1
+        out[n] = c
+        n += 1
+        prev = kind
+    return out[:n]
+
 def preprocess(text):
     text=text.replace('in.',' inch ')
-    words=re.split(r'\W+',text)
-    words=[word.lower() for word in words]
-    res=re.sub("[A-Za-z]+",lambda ele: " " + ele[0] + " ",' '.join(words))
+    if text.isascii():
+        res=_normalize_bytes(np.frombuffer(text.encode('ascii'), dtype=np.uint8)).tobytes().decode('ascii')
+    else:
+        words=_RX_WORDS.split(text)
+        words=[word.lower() for word in words]
+        res=_RX_LETTERS.sub(lambda ele: " " + ele[0] + " ",' '.join(words))
     res=standardize_units(res)
     cleaned=' '.join(res.split())
     return cleaned
 
+def preprocess_column(column):
+    ## queries and titles repeat across many rows, so each distinct string is preprocessed only once
+    unique = column.unique()
+    return column.map(dict(zip(unique, map(preprocess, unique))))
+
+class HostCollateCrossEncoder(CrossEncoder):
+    """CrossEncoder whose training collate leaves batches on the host, so they can be built in
+    DataLoader workers, pinned, and copied to the GPU by CUDAPrefetcher."""
+
+    def smart_batching_collate(self, batch):
+        texts = [[] for _ in range(len(batch[0].texts))]
+        labels = []
+        for example in batch:
+            for idx, text in enumerate(example.texts):
+                texts[idx].append(text.strip())
+            labels.append(example.label)
+        tokenized = self.tokenizer(*texts, padding=True, truncation='longest_first', return_tensors="pt",
+                                   max_length=self.max_length)
+        labels = torch.tensor(labels, dtype=torch.float if self.config.num_labels == 1 else torch.long)
+        return tokenized, labels
+
+
+class CUDAPrefetcher:
+    """Wraps a DataLoader of (features, labels) batches and copies the next batch to the GPU on a
+    side stream while the current one is being trained on."""
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream(device=device)
+
+    @property
+    def collate_fn(self):
+        return self.loader.collate_fn
+
+    @collate_fn.setter
+    def collate_fn(self, collate_fn):
+        ## CrossEncoder.fit installs its collate on whatever it is given as train_dataloader
+        self.loader.collate_fn = collate_fn
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _preload(self, it):
+        batch = next(it, None)
+        if batch is None:
+            return None
+        features, labels = batch
+        with torch.cuda.stream(self.stream):
+            features = {name: tensor.to(self.device, non_blocking=True) for name, tensor in features.items()}
+            labels = labels.to(self.device, non_blocking=True)
+        return features, labels
+
+    def __iter__(self):
+        it = iter(self.loader)
+        next_batch = self._preload(it)
+        while next_batch is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(self.stream)
+            features, labels = next_batch
+            for tensor in (*features.values(), labels):
+                tensor.record_stream(current_stream)
+            next_batch = self._preload(it)
+            yield features, labels
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("train_path_file", type=str, help="Input training CSV with the pairs of queries and products.")
@@ -76,10 +182,32 @@ def main():
     }
     col_gain = 'gain'
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    use_amp = device.type == "cuda"
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.backends.cudnn.benchmark = True
 
     """ 1. Load data """
-    df = pd.read_csv(args.train_path_file)
-    df_product_catalogue = pd.read_csv(args.product_catalogue_path_file)
+    df = pd.read_csv(
+        args.train_path_file,
+        usecols=[col_query_id, col_query, col_query_locale, col_esci_label, col_product_id],
+        dtype={
+            col_query_id: 'int32',
+            col_query_locale: 'category',
+            col_esci_label: 'category',
+            col_product_id: 'string[pyarrow]',
+        },
+        engine='pyarrow',
+    )
+    df_product_catalogue = pd.read_csv(
+        args.product_catalogue_path_file,
+        usecols=[col_product_id, col_product_locale, col_product_title],
+        dtype={
+            col_product_locale: 'category',
+            col_product_id: 'string[pyarrow]',
+        },
+        engine='pyarrow',
+    )
     df = df[df[col_query_locale] == args.locale]
     df_product_catalogue = df_product_catalogue[df_product_catalogue[col_product_locale] == args.locale]
     df = pd.merge(
@@ -94,38 +222,50 @@ def main():
     dev_size = args.n_dev_queries / len(list_query_id)
     list_query_id_train, list_query_id_dev = train_test_split(list_query_id, test_size=dev_size,
                                                               random_state=args.random_state)
-    df[col_gain] = df[col_esci_label].apply(lambda label: esci_label2gain[label])
+    df[col_gain] = df[col_esci_label].map(esci_label2gain).astype(np.float32)
     df = df[[col_query_id, col_query, col_product_title, col_gain,col_esci_label]]
-    df_train = df[df[col_query_id].isin(list_query_id_train)]
-    df_dev = df[df[col_query_id].isin(list_query_id_dev)]
+    ## every query id falls in exactly one split, so the dev rows are the complement of the train mask
+    mask_train = df[col_query_id].isin(pd.Index(list_query_id_train))
+    df_train = df[mask_train]
+    df_dev = df[~mask_train]
 
     if args.locale == 'us':
-        df_train['product_title'] = df_train.apply(lambda x: preprocess(x.product_title), axis=1)  ### added line
-        df_train['query'] = df_train.apply(lambda x: preprocess(x.query), axis=1)  ### added line
-        augmented_text=augment_text(df_train)
-        df_train=df_train[col_query,col_product_title, col_esci_label,col_gain]
-        df_train = pd.concat([df_train, augmented_text], ignore_index=True, sort=False)
+        df_train['product_title'] = preprocess_column(df_train['product_title'])  ### added line
+        df_train['query'] = preprocess_column(df_train['query'])  ### added line
+        augmented_text=augment_text(df_train, random_state=args.random_state)
+        cols_train = [col_query, col_product_title, col_esci_label, col_gain]
+        df_train = pd.concat([df_train[cols_train], augmented_text[cols_train]], ignore_index=True, sort=False)
 
     """ 2. Prepare data loaders """
-    train_samples = []
-    for (_, row) in df_train.iterrows():
-        train_samples.append(InputExample(texts=[row[col_query], row[col_product_title]], label=float(row[col_gain])))
-    train_dataloader = DataLoader(train_samples, shuffle=True, batch_size=args.train_batch_size, drop_last=True)
+    train_samples = [
+        InputExample(texts=[query, title], label=gain)
+        for query, title, gain in zip(
+            df_train[col_query].tolist(),
+            df_train[col_product_title].tolist(),
+            df_train[col_gain].to_numpy(dtype=np.float32).tolist(),
+        )
+    ]
+    ## both collates tokenize on the host, so batches are built in workers and pinned for async copies
+    train_dataloader = DataLoader(
+        train_samples,
+        shuffle=True,
+        batch_size=args.train_batch_size,
+        drop_last=True,
+        pin_memory=torch.cuda.is_available(),
+        num_workers=min(8, os.cpu_count() or 1),
+        persistent_workers=True,
+        prefetch_factor=4,
+    )
     if args.locale == "us":
         dev_samples = {}
-        query2id = {}
-        for (_, row) in df_dev.iterrows():
-            try:
-                qid = query2id[row[col_query]]
-            except KeyError:
-                qid = len(query2id)
-                query2id[row[col_query]] = qid
-            if qid not in dev_samples:
-                dev_samples[qid] = {'query': row[col_query], 'positive': set(), 'negative': set()}
-            if row[col_gain] > 0:
-                dev_samples[qid]['positive'].add(row[col_product_title])
-            else:
-                dev_samples[qid]['negative'].add(row[col_product_title])
+        for qid, (query, df_query) in enumerate(df_dev.groupby(col_query, sort=False)):
+            titles = df_query[col_product_title].to_numpy()
+            is_positive = df_query[col_gain].to_numpy() > 0
+            dev_samples[qid] = {
+                'query': query,
+                'positive': set(titles[is_positive]),
+                'negative': set(titles[~is_positive]),
+            }
         evaluator = CERerankingEvaluator(dev_samples, name='train-eval')
 
         """ 3. Prepare Cross-enconder model:
@@ -136,7 +276,7 @@ def main():
         num_labels = 1
         max_length = 512
         default_activation_function = torch.nn.Identity()
-        model = CrossEncoder(
+        model = HostCollateCrossEncoder(
             model_name,
             num_labels=num_labels,
             max_length=max_length,
@@ -147,6 +287,8 @@ def main():
         evaluation_steps = 5000
         warmup_steps = 5000
         lr = 7e-6
+        if device.type == "cuda":
+            train_dataloader = CUDAPrefetcher(train_dataloader, device)
         """ 4. Train Cross-encoder model """
         model.fit(
             train_dataloader=train_dataloader,
@@ -158,6 +300,7 @@ def main():
             output_path=f"{args.model_save_path}_tmp",
             optimizer_params={'lr': lr},
             scheduler='warmupcosine',
+            use_amp=use_amp,
         )
         model.save(args.model_save_path)
         evaluator = CECorrelationEvaluator.from_input_examples(test_samples, name='sts-test')
@@ -183,6 +326,7 @@ def main():
             epochs=num_epochs,
             evaluation_steps=evaluation_steps,
             output_path=args.model_save_path,
+            use_amp=use_amp,
         )
         evaluator(model)
 